@@ -1,18 +1,210 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, abort
+from urllib.parse import quote
+from werkzeug.security import safe_join
+import collections
+import mimetypes
 import os
-from display.epaper import display_image, display_text
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from display.epaper import display_image, display_text, discard_framebuffer
 
 app = Flask(__name__)
 
+# Largest BMP accepted; bigger request bodies are rejected with 413
+MAX_BMP_BYTES = 25 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_BMP_BYTES
+
 # Configure upload folder
 UPLOAD_FOLDER = 'bmps'
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
+# When set (e.g. '/_protected_bmps/'), image downloads are handed to nginx
+# with an X-Accel-Redirect header instead of being sent through Python
+X_ACCEL_REDIRECT_PREFIX = os.environ.get('X_ACCEL_REDIRECT_PREFIX')
+
+# Block size used when copying a raw upload body to disk
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Size of the BMP file header: 'BM' signature followed by the file size
+BMP_HEADER_SIZE = 14
+
+def _read_exactly(stream, size):
+    """
+    Read up to size bytes from a stream, stopping early only at end of stream
+    """
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+# The image listing is cached for a couple of seconds and dropped on upload
+_LIST_TTL = 2.0
+_listing_cache = {'t': 0.0, 'v': [], 'generation': 0}
+_listing_lock = threading.Lock()
+
+def _list_bmps():
+    """
+    Return the names of the BMP files in the upload folder
+    """
+    now = time.monotonic()
+    with _listing_lock:
+        if now - _listing_cache['t'] < _LIST_TTL:
+            return _listing_cache['v']
+        generation = _listing_cache['generation']
+
+    # Match the extension case-insensitively, as the upload endpoints do
+    with os.scandir(UPLOAD_FOLDER) as entries:
+        files = [entry.name for entry in entries if entry.name[-4:].lower() == '.bmp']
+
+    # Timestamp the listing with the time the scan started, and don't cache
+    # it at all if an upload invalidated the cache while we were scanning
+    with _listing_lock:
+        if _listing_cache['generation'] == generation:
+            _listing_cache['v'] = files
+            _listing_cache['t'] = now
+    return files
+
+def _invalidate_listing():
+    with _listing_lock:
+        _listing_cache['t'] = 0.0
+        _listing_cache['generation'] += 1
+
+# Display jobs are run one at a time by a background worker thread so
+# requests don't wait on the e-paper refresh. Only the latest job is kept:
+# a frame that is replaced before it is drawn would never be seen anyway.
+_pending_jobs = collections.deque(maxlen=1)
+_pending_cond = threading.Condition()
+
+# Status of recent display jobs, keyed by job id
+MAX_TRACKED_JOBS = 100
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+def _set_job_status(job_id, status):
+    with _jobs_lock:
+        _jobs[job_id] = status
+        # Forget the oldest jobs so the table doesn't grow forever
+        while len(_jobs) > MAX_TRACKED_JOBS:
+            del _jobs[next(iter(_jobs))]
+
+def _do_display(job):
+    """
+    Run a single display job on the e-paper display
+    """
+    job_id, kind, args = job
+    _set_job_status(job_id, 'running')
+
+    if kind == 'image':
+        success = display_image(*args)
+    else:
+        success = display_text(*args)
+
+    _set_job_status(job_id, 'done' if success else 'failed')
+
+def _display_worker():
+    while True:
+        with _pending_cond:
+            while not _pending_jobs:
+                _pending_cond.wait()
+            job = _pending_jobs.popleft()
+        try:
+            _do_display(job)
+        except Exception as e:
+            print(f"Display job failed: {e}")
+            _set_job_status(job[0], 'failed')
+
+threading.Thread(target=_display_worker, daemon=True).start()
+
+def enqueue_display(kind, *args):
+    """
+    Queue a display job for the background worker, replacing any job that
+    hasn't started yet
+
+    Returns:
+        str: The job id
+    """
+    job_id = uuid.uuid4().hex
+    _set_job_status(job_id, 'queued')
+    with _pending_cond:
+        if _pending_jobs:
+            _set_job_status(_pending_jobs[0][0], 'superseded')
+        _pending_jobs.clear()
+        _pending_jobs.append((job_id, kind, args))
+        _pending_cond.notify()
+    return job_id
+
+def _display_uploaded(filename, file_path):
+    """
+    Queue a freshly saved upload for display and build the endpoint response
+    """
+    job_id = enqueue_display('image', file_path)
+
+    return jsonify({'message': f'File {filename} uploaded and queued for display', 'job_id': job_id}), 202
+
+@app.route('/upload/<filename>', methods=['PUT'])
+def upload_image_stream(filename):
+    """
+    Endpoint to upload a BMP image sent as the raw request body
+
+    The body is copied straight from request.stream to disk in fixed-size
+    blocks, so werkzeug's multipart parser is never involved. The BMP header
+    is checked before anything is written.
+    """
+    # Check if it's a BMP file
+    if not filename.lower().endswith('.bmp'):
+        return jsonify({'error': 'Only BMP files are allowed'}), 400
+
+    # Check the BMP signature and declared file size
+    header = _read_exactly(request.stream, BMP_HEADER_SIZE)
+    if len(header) < BMP_HEADER_SIZE or header[:2] != b'BM':
+        return jsonify({'error': 'File is not a BMP image'}), 400
+
+    declared_size = int.from_bytes(header[2:6], 'little')
+    if declared_size > MAX_BMP_BYTES:
+        return jsonify({'error': 'BMP image is too large'}), 413
+
+    # Stream the body to a temporary file of its own, so a failed upload
+    # never replaces an existing image and concurrent uploads of the same
+    # name can't write into each other
+    file_path = os.path.join(UPLOAD_FOLDER, filename)
+    fd, part_path = tempfile.mkstemp(dir=UPLOAD_FOLDER, prefix='.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(header)
+            shutil.copyfileobj(request.stream, out, UPLOAD_CHUNK_SIZE)
+            size = out.tell()
+
+        # Some encoders leave the size field as 0, so only check it when it's set
+        if declared_size and size != declared_size:
+            os.remove(part_path)
+            return jsonify({'error': 'BMP size does not match its header'}), 400
+
+        # mkstemp creates the file readable by its owner only
+        os.chmod(part_path, 0o644)
+        os.replace(part_path, file_path)
+    except BaseException:
+        # The client disconnected, the body was too large, or the disk is full
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    discard_framebuffer(file_path)
+    _invalidate_listing()
+
+    return _display_uploaded(filename, file_path)
+
 @app.route('/upload', methods=['POST'])
 def upload_image():
     """
-    Endpoint to upload BMP images
+    Endpoint to upload BMP images as multipart form data
+
+    Deprecated: use PUT /upload/<filename> with the BMP as the request body.
     """
     # Check if the post request has the file part
     if 'file' not in request.files:
@@ -31,51 +223,78 @@ def upload_image():
     # Save the file
     file_path = os.path.join(UPLOAD_FOLDER, file.filename)
     file.save(file_path)
+    discard_framebuffer(file_path)
+    _invalidate_listing()
 
-    # Display the image on e-paper display
-    success = display_image(file_path)
-
-    if success:
-        return jsonify({'message': f'File {file.filename} uploaded and displayed successfully'}), 201
-    else:
-        return jsonify({'message': f'File {file.filename} uploaded but display failed'}), 500
+    return _display_uploaded(file.filename, file_path)
 
 @app.route('/images', methods=['GET'])
 def list_images():
     """
     Endpoint to list all uploaded BMP images
     """
-    files = []
-    for filename in os.listdir(UPLOAD_FOLDER):
-        if filename.lower().endswith('.bmp'):
-            files.append(filename)
-    
-    return jsonify({'images': files})
+    return jsonify({'images': _list_bmps()})
 
 @app.route('/check', methods=['POST'])
 def check_image():
     """
-    Endpoint to check if a specific image exists
+    Endpoint to check if a specific image, or a list of images, exists
+    
+    Send {"filenames": [...]} to check several images with one request.
+    Both forms answer from the same BMP listing as /images, so only BMP
+    images are reported as existing.
     """
     data = request.json
     
+    if data and 'filenames' in data:
+        filenames = data['filenames']
+        if not isinstance(filenames, list) or not all(isinstance(fn, str) for fn in filenames):
+            return jsonify({'error': 'Filenames must be a list of strings'}), 400
+        
+        # One directory scan (usually cached) answers every name
+        present = set(_list_bmps())
+        return jsonify({'results': {fn: fn in present for fn in filenames}})
+    
     if not data or 'filename' not in data:
         return jsonify({'error': 'Filename is required'}), 400
     
     filename = data['filename']
-    file_path = os.path.join(UPLOAD_FOLDER, filename)
     
-    if os.path.exists(file_path):
-        return jsonify({'exists': True, 'filename': filename})
-    
-    return jsonify({'exists': False, 'filename': filename})
+    return jsonify({'exists': filename in _list_bmps(), 'filename': filename})
 
 @app.route('/images/<filename>', methods=['GET'])
 def get_image(filename):
     """
     Endpoint to retrieve a specific image
     """
-    return send_from_directory(UPLOAD_FOLDER, filename)
+    if not X_ACCEL_REDIRECT_PREFIX:
+        return send_from_directory(UPLOAD_FOLDER, filename)
+    
+    # Let nginx send the file; it answers 404 itself if the file is missing
+    if safe_join(UPLOAD_FOLDER, filename) is None:
+        abort(404)
+    
+    response = app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    response.headers['X-Accel-Redirect'] = X_ACCEL_REDIRECT_PREFIX + quote(filename)
+    return response
+
+@app.route('/display/<filename>', methods=['POST'])
+def show_image(filename):
+    """
+    Endpoint to display an already uploaded image again
+    """
+    # Check if it's a BMP file
+    if not filename.lower().endswith('.bmp'):
+        return jsonify({'error': 'Only BMP files are allowed'}), 400
+    
+    file_path = safe_join(UPLOAD_FOLDER, filename)
+    if file_path is None or not os.path.isfile(file_path):
+        return jsonify({'error': 'Image not found'}), 404
+    
+    # Reuse the framebuffer packed when the image was first displayed
+    job_id = enqueue_display('image', file_path, True)
+    
+    return jsonify({'message': f'File {filename} queued for display', 'job_id': job_id}), 202
 
 @app.route('/display-text', methods=['POST'])
 def show_text():
@@ -93,13 +312,23 @@ def show_text():
     max_width = data.get('max_width', 122)
     max_height = data.get('max_height', 250)
     
-    # Display the text on e-paper display
-    success = display_text(text, max_width, max_height)
+    # Queue the text for the e-paper display
+    job_id = enqueue_display('text', text, max_width, max_height)
     
-    if success:
-        return jsonify({'message': 'Text displayed successfully'}), 200
-    else:
-        return jsonify({'error': 'Failed to display text'}), 500
+    return jsonify({'message': 'Text queued for display', 'job_id': job_id}), 202
+
+@app.route('/status/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    Endpoint to check the status of a display job
+    """
+    with _jobs_lock:
+        status = _jobs.get(job_id)
+    
+    if status is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    
+    return jsonify({'job_id': job_id, 'status': status})
 
 if __name__ == '__main__':
     app.run(host="0.0.0.0", debug=False)
\ No newline at end of file
@@ -3,20 +3,31 @@ Waveshare E-Paper Display Module
 
 This module provides functions to control the Waveshare e-paper display.
 """
+import functools
+import hashlib
+import io
 import platform
 import os
-import time
+import tempfile
 from PIL import Image, ImageDraw, ImageFont
 import os.path
 
 # Check if we're running on a Raspberry Pi
+@functools.lru_cache(maxsize=1)
 def is_raspberry_pi():
     """
     Check if the current system is a Raspberry Pi
     
+    The result is cached, so only the first call touches the filesystem.
+    
     Returns:
         bool: True if running on a Raspberry Pi, False otherwise
     """
+    # Every Raspberry Pi is an ARM board, so rule out everything else
+    # without touching the filesystem
+    if not platform.machine().startswith(('arm', 'aarch64')):
+        return False
+    
     # Check for Raspberry Pi model in /proc/device-tree/model
     try:
         with open('/proc/device-tree/model', 'r') as f:
@@ -26,8 +37,12 @@ def is_raspberry_pi():
         # Handle the case where the file doesn't exist or can't be read
         pass
     
-    # Alternative check for arm processor and specific hardware
-    return platform.machine().startswith('arm') and os.path.exists('/dev/gpiomem')
+    # Alternative check for the GPIO memory device
+    try:
+        os.stat('/dev/gpiomem')
+        return True
+    except OSError:
+        return False
 
 # Import the e-paper library only if we're on a Raspberry Pi
 if is_raspberry_pi():
@@ -42,43 +57,204 @@ else:
     print("Not running on Raspberry Pi - e-paper display functionality will be simulated")
     PI_AVAILABLE = False
 
-def init_and_clear_display():
+# Range of font sizes tried when fitting text to the display
+MIN_FONT_SIZE = 8
+MAX_FONT_SIZE = 40
+
+@functools.lru_cache(maxsize=None)
+def _read_font_file(path):
+    """
+    Read a font file into memory once
+    """
+    with open(path, 'rb') as f:
+        return f.read()
+
+@functools.lru_cache(maxsize=64)
+def _get_font(path, size):
+    """
+    Load a TrueType font, reusing it if it has been loaded before
+    """
+    return ImageFont.truetype(io.BytesIO(_read_font_file(path)), size)
+
+def fit_image_to_display(image, width, height):
+    """
+    Fit an image onto a white canvas the size of the display
+    
+    Landscape images are fitted to the display turned sideways, which the
+    driver's getbuffer rotates for us. Images bigger than the display are
+    shrunk, keeping their aspect ratio; smaller ones are never enlarged.
+    The image is centered on the canvas. Images that are already the display
+    size are returned untouched.
+    
+    Args:
+        image (PIL.Image.Image): Freshly opened image
+        width (int): Display width in pixels
+        height (int): Display height in pixels
+    
+    Returns:
+        PIL.Image.Image: Image sized for the display
+    """
+    if image.width > image.height:
+        width, height = height, width
+    
+    if image.size == (width, height):
+        return image
+    
+    # Let decoders that support it (e.g. JPEG) decode at a reduced size
+    image.draft(image.mode, (width, height))
+    image = image.convert('L')
+    
+    if image.width > width or image.height > height:
+        scale = min(width / image.width, height / image.height)
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.BICUBIC)
+    
+    canvas = Image.new('L', (width, height), 255)
+    canvas.paste(image, ((width - image.width) // 2, (height - image.height) // 2))
+    return canvas
+
+# Pre-packed framebuffers are kept in a hidden folder next to the images,
+# out of reach of the image download endpoint
+FRAMEBUFFER_DIR = '.epdbuf'
+
+def _framebuffer_path(image_path):
+    folder, name = os.path.split(image_path)
+    return os.path.join(folder, FRAMEBUFFER_DIR, name + '.epdbuf')
+
+def prerender_image(epd, image_path):
     """
-    Initialize and clear the e-paper display
-    Returns the initialized EPD object
+    Pack an image into the display's framebuffer format
+    
+    A copy of the framebuffer is saved so the image can be shown again later
+    without going through PIL; failing to save it is not an error.
+    
+    Args:
+        epd (EPD): Driver object for the display
+        image_path (str): Path to the BMP image file
+    
+    Returns:
+        bytes: The packed framebuffer
     """
-    if PI_AVAILABLE:
-        epd = epd2in13.EPD()
+    # Note the image's mtime before reading it, so the saved copy is tied to
+    # the version of the image it was packed from
+    image_stat = os.stat(image_path)
+    image = fit_image_to_display(Image.open(image_path), epd.width, epd.height)
+    buf = bytes(epd.getbuffer(image))
+    
+    buffer_path = _framebuffer_path(image_path)
+    try:
+        os.makedirs(os.path.dirname(buffer_path), exist_ok=True)
+        fd, part_path = tempfile.mkstemp(dir=os.path.dirname(buffer_path), suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(buf)
+            os.utime(part_path, ns=(image_stat.st_atime_ns, image_stat.st_mtime_ns))
+            os.replace(part_path, buffer_path)
+        except BaseException:
+            os.remove(part_path)
+            raise
+    except OSError as e:
+        print(f"Could not save framebuffer: {e}")
+    
+    return buf
+
+def discard_framebuffer(image_path):
+    """
+    Delete the saved framebuffer for an image, if there is one
+    """
+    try:
+        os.remove(_framebuffer_path(image_path))
+    except FileNotFoundError:
+        pass
+
+def load_framebuffer(image_path):
+    """
+    Load the pre-packed framebuffer for an image
+    
+    Returns:
+        bytes: The framebuffer, or None if there isn't one or it was packed
+        from a different version of the image
+    """
+    buffer_path = _framebuffer_path(image_path)
+    try:
+        # prerender_image gives the buffer the mtime of the image it packed
+        if os.stat(buffer_path).st_mtime_ns != os.stat(image_path).st_mtime_ns:
+            return None
+        with open(buffer_path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+# Drawing context used only to measure text; the target image doesn't matter
+_measure_draw = ImageDraw.Draw(Image.new('1', (1, 1)))
+
+@functools.lru_cache(maxsize=8)
+def _blank_canvas(width, height):
+    """
+    Return a shared blank white image; copy it before drawing on it
+    """
+    return Image.new('1', (width, height), 255)  # '1' mode is 1-bit pixels, black and white
+
+# What is known to be on the panel. The panel keeps its image while asleep,
+# so once it has been cleared a new frame can be drawn straight over the
+# previous one, and a frame identical to the last one needs no refresh.
+_epd_state = {'initialized': False, 'last_frame_hash': None}
+
+def show_framebuffer(epd, buf):
+    """
+    Draw a packed framebuffer on the e-paper display and put it to sleep
+    
+    The display is only cleared on the first frame, and the refresh is
+    skipped entirely if the frame is already on the panel.
+    
+    Args:
+        epd (EPD): Driver object for the display
+        buf: Framebuffer packed by epd.getbuffer
+    """
+    frame_hash = hashlib.blake2b(bytes(buf), digest_size=8).digest()
+    if _epd_state['initialized'] and frame_hash == _epd_state['last_frame_hash']:
+        print("Frame already on display, skipping refresh")
+        return
+    
+    if _epd_state['initialized']:
+        # Wake the display from deep sleep without clearing it
+        epd.init(epd.lut_full_update)
+    else:
         print("Initializing and clearing display")
         epd.init(epd.lut_full_update)
         epd.Clear(0xFF)
-        time.sleep(2)
-        return epd
-    else:
-        print("Simulating display initialization and clearing")
-        return None
+        _epd_state['initialized'] = True
+    
+    # Clear and display both wait on the BUSY pin until the refresh is done,
+    # so no extra delay is needed before sleeping
+    _epd_state['last_frame_hash'] = None
+    epd.display(buf)
+    _epd_state['last_frame_hash'] = frame_hash
+    
+    # Put the display to sleep to save power
+    epd.sleep()
 
-def display_image(image_path):
+def display_image(image_path, use_saved=False):
     """
     Display an image on the e-paper display
     
     Args:
         image_path (str): Path to the BMP image file
+        use_saved (bool): Use the framebuffer saved when the image was last
+            displayed, if it is still up to date (default: False)
     
     Returns:
         bool: True if successful, False otherwise
     """
     try:
         if PI_AVAILABLE:
-            epd = init_and_clear_display()
+            epd = epd2in13.EPD()
             print(f"Displaying image: {image_path}")
             
-            image = Image.open(image_path)
-            epd.display(epd.getbuffer(image))
-            time.sleep(2)
-            
-            # Put the display to sleep to save power
-            epd.sleep()
+            buf = load_framebuffer(image_path) if use_saved else None
+            if buf is None:
+                buf = prerender_image(epd, image_path)
+            show_framebuffer(epd, buf)
         else:
             # Mock implementation for development
             print(f"[MOCK] Would display image: {image_path}")
@@ -116,43 +292,51 @@ def display_text(text, max_width=122, max_height=250, rotate=True):
         else:
             layout_width, layout_height = max_width, max_height
             
-        # Create a blank white image for the text
-        image = Image.new('1', (layout_width, layout_height), 255)  # '1' mode is 1-bit pixels, black and white
-        draw = ImageDraw.Draw(image)
-        
-        # Start with a reasonable font size
-        font_size = 40
-        font = ImageFont.truetype(font_path, font_size)
+        def fits(size):
+            width, height = _measure_draw.textbbox((0, 0), text, font=_get_font(font_path, size))[2:]
+            return width <= layout_width - 10 and height <= layout_height - 10
         
-        # Calculate text size and adjust font size to fit
-        text_width, text_height = draw.textbbox((0, 0), text, font=font)[2:]
+        # Binary search for the largest font size that fits within the display,
+        # falling back to the smallest size if nothing fits
+        low, high = MIN_FONT_SIZE, MAX_FONT_SIZE
+        while low < high:
+            mid = (low + high + 1) // 2
+            if fits(mid):
+                low = mid
+            else:
+                high = mid - 1
         
-        # Dynamically adjust font size to fit within display
-        while (text_width > layout_width - 10 or text_height > layout_height - 10) and font_size > 8:
-            font_size -= 2
-            font = ImageFont.truetype(font_path, font_size)
-            text_width, text_height = draw.textbbox((0, 0), text, font=font)[2:]
+        font_size = low
+        font = _get_font(font_path, font_size)
+        left, top, text_width, text_height = _measure_draw.textbbox((0, 0), text, font=font)
         
         # Calculate position to center the text
         x = (layout_width - text_width) // 2
         y = (layout_height - text_height) // 2
         
-        # Draw the text on the image
-        draw.text((x, y), text, font=font, fill=0)
+        # Draw the text on an image just big enough to hold it, including any
+        # glyph parts that extend above or left of the origin
+        offset_x, offset_y = min(left, 0), min(top, 0)
+        text_image = Image.new('1', (text_width - offset_x, text_height - offset_y), 255)
+        ImageDraw.Draw(text_image).text((-offset_x, -offset_y), text, font=font, fill=0)
+        x += offset_x
+        y += offset_y
         
-        # Rotate the image if needed
+        # Paste the text onto a blank image that already has the final
+        # orientation, so only the small text image has to be rotated
         if rotate:
             # Rotate 90 degrees counterclockwise
-            image = image.rotate(270, expand=True)
+            text_image = text_image.rotate(270, expand=True)
+            image = _blank_canvas(layout_height, layout_width).copy()
+            image.paste(text_image, (layout_height - y - text_image.width, x))
+        else:
+            image = _blank_canvas(layout_width, layout_height).copy()
+            image.paste(text_image, (x, y))
         
         if PI_AVAILABLE:
-            epd = init_and_clear_display()
+            epd = epd2in13.EPD()
             print(f"Displaying text: {text}")
-            epd.display(epd.getbuffer(image))
-            time.sleep(2)
-            
-            # Put the display to sleep to save power
-            epd.sleep()
+            show_framebuffer(epd, epd.getbuffer(image))
         else:
             # Mock implementation for development
             print(f"[MOCK] Would display text: {text}")
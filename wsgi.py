@@ -0,0 +1,6 @@
+"""
+WSGI entry point for running the app under gunicorn
+"""
+from app import app
+
+application = app